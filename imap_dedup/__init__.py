@@ -2,26 +2,38 @@
 
 import click
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from imapclient import IMAPClient
+from imapclient.exceptions import IMAPClientError
+from itertools import groupby, islice
+from operator import itemgetter
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Dict, List, Optional
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Set
 import sqlite3
 import logging
+import queue
+import threading
 from tqdm import tqdm
 from retrying import retry
 from enum import Enum
+from functools import lru_cache, partial
 from tabulate import tabulate
 
 MESSAGE_ENVELOPE = "ENVELOPE"
 MESSAGE_DATE = "INTERNALDATE"
 MESSAGE_SIZE = "RFC822.SIZE"
 MESSAGE_SUBJECT = "BODY.PEEK[HEADER.FIELDS (SUBJECT)]"
-BATCH_FETCH_LIMIT = 25
+_KEY_SEQ = b"SEQ"
+_KEY_ENVELOPE = MESSAGE_ENVELOPE.encode()
+_KEY_DATE = MESSAGE_DATE.encode()
+_KEY_SIZE = MESSAGE_SIZE.encode()
+BATCH_FETCH_LIMIT = 100
+BATCH_COMMIT_SIZE = 2000
+PULL_WORKERS = 4
 
 
-@dataclass
-class MessageRecord:
+class MessageRecord(NamedTuple):
     folder: str
     seq: int
     subject: str
@@ -54,12 +66,11 @@ def _optional_utf8(item: Optional[bytes]) -> Optional[str]:
 
 
 def create_message_record(folder: str, message: Dict) -> MessageRecord:
-    seq = message[b"SEQ"]
-    try:
-        envelope = message[MESSAGE_ENVELOPE.encode()]
-        date_ = message[MESSAGE_DATE.encode()]
-        size = message[MESSAGE_SIZE.encode()]
-    except KeyError:
+    seq = message[_KEY_SEQ]
+    envelope = message.get(_KEY_ENVELOPE)
+    date_ = message.get(_KEY_DATE)
+    size = message.get(_KEY_SIZE)
+    if envelope is None or date_ is None or size is None:
         raise BadFetchError()
 
     return MessageRecord(
@@ -72,6 +83,10 @@ def create_message_record(folder: str, message: Dict) -> MessageRecord:
     )
 
 
+def _is_request_too_large(e: IMAPClientError) -> bool:
+    return "maximum request size" in str(e).lower()
+
+
 def create_database_tables(cursor: sqlite3.Cursor) -> None:
     cursor.execute(
         "CREATE TABLE IF NOT EXISTS messages (folder VARCHAR(128), seq INT, subject TEXT, message_id TEXT, date DATETIME, size INT, PRIMARY KEY (folder, seq))"
@@ -79,112 +94,89 @@ def create_database_tables(cursor: sqlite3.Cursor) -> None:
     cursor.execute(
         "CREATE TABLE IF NOT EXISTS actions (folder VARCHAR(128), seq INT, action TEXT, completed_at DATETIME, PRIMARY KEY (folder, seq))"
     )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_mid_size ON messages (message_id, size)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_actions_pending_folder_seq ON actions (folder, seq) WHERE completed_at IS NULL"
+    )
 
 
-detected_duplicates = False
-
-
-def _is_unique_constraint_violation(e: sqlite3.IntegrityError) -> bool:
-    return str(e).startswith("UNIQUE constraint failed")
+@lru_cache(maxsize=1)
+def _warn_detected_duplicates() -> None:
+    logging.warning("Detected duplicates, keeping the records already stored")
 
 
-def insert_message_record(
-    cursor: sqlite3.Cursor, message_record: MessageRecord
+def insert_message_records(
+    cursor: sqlite3.Cursor, message_records: List[MessageRecord]
 ) -> None:
-    global detected_duplicates
-    try:
-        cursor.execute(
-            "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)",
-            [
-                message_record.folder,
-                message_record.seq,
-                message_record.subject,
-                message_record.message_id,
-                message_record.date_,
-                message_record.size,
-            ],
-        )
-    except sqlite3.IntegrityError as e:
-        if _is_unique_constraint_violation(e):
-            if not detected_duplicates:
-                logging.warning(
-                    "Detected duplicates (example: folder=%s, seq=%d)",
-                    message_record.folder,
-                    message_record.seq,
-                )
-                detected_duplicates = True
-        else:
-            raise e
+    # MessageRecord fields are in column order, so records bind directly
+    cursor.executemany(
+        "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?)", message_records
+    )
+    if cursor.rowcount < len(message_records):
+        _warn_detected_duplicates()
 
 
-def message_record_exists(cursor: sqlite3.Cursor, folder: str, seq: int) -> bool:
-    return (
-        len(
-            cursor.execute(
-                "SELECT folder, seq FROM messages WHERE folder=? and seq=?",
-                [folder, seq],
-            ).fetchall()
-        )
-        > 0
-    )
+def find_seqs_by_folder(cursor: sqlite3.Cursor) -> Dict[str, Set[int]]:
+    seqs_by_folder = defaultdict(set)
+    for folder, seq in cursor.execute("SELECT folder, seq FROM messages"):
+        seqs_by_folder[folder].add(seq)
+    return seqs_by_folder
 
 
 def insert_action_record(cursor: sqlite3.Cursor, action_record: ActionRecord) -> None:
-    try:
-        cursor.execute(
-            "INSERT INTO actions (folder, seq, action) VALUES (?, ?, ?)",
-            [action_record.folder, action_record.seq, action_record.action.name],
-        )
-    except sqlite3.IntegrityError as e:
-        if not _is_unique_constraint_violation(e):
-            raise e
+    cursor.execute(
+        "INSERT OR IGNORE INTO actions (folder, seq, action) VALUES (?, ?, ?)",
+        [action_record.folder, action_record.seq, action_record.action.name],
+    )
 
 
-def find_pending_action_records(cursor: sqlite3.Cursor) -> List[ActionRecord]:
+def find_pending_action_records(cursor: sqlite3.Cursor) -> sqlite3.Cursor:
     query = """
   SELECT
     folder,
-    seq,
-    action
+    seq
   FROM actions
   WHERE completed_at is NULL
+  ORDER BY folder, seq
   """
-    return [
-        ActionRecord(r[0], r[1], r[2], None) for r in cursor.execute(query).fetchall()
-    ]
+    return cursor.execute(query)
 
 
-def find_action_by_message(cursor: sqlite3.Cursor, message: MessageRecord):
-    query = """
-  SELECT
-    action
-  FROM actions
-  WHERE
-    folder = ? and
-    seq = ? and
-    completed_at is NULL
-  """
-    return [
-        ActionRecord(
-            folder=message.folder, seq=message.seq, action=r[0], completed_at=None
-        )
-        for r in cursor.execute(query, [message.folder, message.seq]).fetchall()
-    ]
+def mark_actions_completed(cursor: sqlite3.Cursor, folder: str) -> None:
+    cursor.execute(
+        "UPDATE actions SET completed_at=? WHERE folder=? and completed_at is NULL",
+        [datetime.now(timezone.utc), folder],
+    )
 
 
-def find_duplicate_messages(cursor: sqlite3.Cursor) -> List[str]:
+def find_duplicate_messages(cursor: sqlite3.Cursor) -> Iterator[str]:
     query = """
   SELECT
-    message_id,
-    count(*) as cnt,
-    size
+    message_id
   FROM messages
   WHERE message_id IS NOT NULL
   GROUP BY message_id, size
-  ORDER BY cnt DESC, message_id ASC
+  HAVING count(*) > 1
+  ORDER BY count(*) DESC, message_id ASC
   """
-    records = cursor.execute(query).fetchall()
-    return [r[0] for r in records if r[1] > 1]
+    return (r[0] for r in cursor.execute(query))
+
+
+def count_duplicate_messages(cursor: sqlite3.Cursor) -> int:
+    query = """
+  SELECT
+    count(*)
+  FROM (
+    SELECT 1
+    FROM messages
+    WHERE message_id IS NOT NULL
+    GROUP BY message_id, size
+    HAVING count(*) > 1
+  )
+  """
+    return cursor.execute(query).fetchone()[0]
 
 
 def find_message_records_with_id(
@@ -201,18 +193,82 @@ def find_message_records_with_id(
   FROM messages
   WHERE message_id=?
   """
-    return [
-        MessageRecord(r[0], r[1], r[2], r[3], r[4], r[5])
-        for r in cursor.execute(query, [message_id]).fetchall()
-    ]
+    return list(map(MessageRecord._make, cursor.execute(query, [message_id])))
 
 
-def chunk(arr, limit):
-    chunks = []
-    while len(arr) > 0:
-        chunks.append(arr[:limit])
-        arr = arr[limit:]
-    return chunks
+def find_duplicate_message_actions(cursor: sqlite3.Cursor) -> sqlite3.Cursor:
+    query = """
+  SELECT
+    m.message_id,
+    m.subject,
+    m.folder,
+    a.action
+  FROM messages m
+  LEFT JOIN actions a ON
+    a.folder = m.folder and
+    a.seq = m.seq and
+    a.completed_at is NULL
+  WHERE m.message_id IN (
+    SELECT message_id
+    FROM messages
+    WHERE message_id IS NOT NULL
+    GROUP BY message_id, size
+    HAVING count(*) > 1
+  )
+  ORDER BY m.message_id ASC
+  """
+    return cursor.execute(query)
+
+
+def chunk(iterable, limit):
+    if limit < 1:
+        raise ValueError(f"Chunk limit must be at least 1, got {limit}")
+
+    iterator = iter(iterable)
+    while True:
+        chunk_ = list(islice(iterator, limit))
+        if len(chunk_) == 0:
+            return
+        yield chunk_
+
+
+@dataclass
+class ServerSession:
+    server: IMAPClient
+    # Lowered when the server rejects a request as too large, so later
+    # requests on this connection go straight to the size it accepts
+    batch_size: int
+    selected_folder: Optional[str] = None
+
+
+def send_in_batches(session: ServerSession, seqs: List[int], send) -> List:
+    """
+    Calls send with consecutive slices of seqs no larger than the session's
+    batch size, halving the batch size when the server rejects a request
+
+    :send: Function taking one batch of seqs
+    """
+    results = []
+    start = 0
+    while start < len(seqs):
+        batch = seqs[start : start + session.batch_size]
+        try:
+            results.append(send(batch))
+        except IMAPClientError as e:
+            if len(batch) == 1 or not _is_request_too_large(e):
+                raise e
+
+            session.batch_size = len(batch) // 2
+            logging.info(
+                "Server rejected %d messages per request, lowering batch size to %d",
+                len(batch),
+                session.batch_size,
+            )
+            continue
+
+        start += len(batch)
+
+    return results
 
 
 @retry(
@@ -221,41 +277,67 @@ def chunk(arr, limit):
     wait_exponential_max=1000,
     wait_exponential_multiplier=50,
 )
-def load_messages_fetched_from_imap_with_retry(
-    connection, server, message_seq_chunk, folder
-):
+def fetch_message_records_with_retry(
+    server, seqs_to_fetch, folder
+) -> List[MessageRecord]:
     """
-    :connection: The connection to the SQLite database
     :server: IMAP server connection
+    :seqs_to_fetch: Sequence numbers to fetch from the selected folder
     """
-    seqs_to_fetch = [
-        s
-        for s in message_seq_chunk
-        if not message_record_exists(connection.cursor(), folder, s)
-    ]
-
     messages = server.fetch(
         seqs_to_fetch, [MESSAGE_ENVELOPE, MESSAGE_DATE, MESSAGE_SIZE]
     )
+
+    records = []
     for seq in messages.keys():
         try:
-            record = create_message_record(folder, messages[seq])
+            records.append(create_message_record(folder, messages[seq]))
         except BadFetchError as e:
             logging.warning(
                 "Detected bad fetch for folder %s, messages starting at %d", folder, seq
             )
-            connection.rollback()
             raise e
 
-        insert_message_record(connection.cursor(), record)
+    return records
+
 
-    connection.commit()
+def fetch_message_records(
+    session: ServerSession, seqs_to_fetch, folder
+) -> List[MessageRecord]:
+    # Only the batch that hit a bad fetch is retried, never its neighbours
+    batches = send_in_batches(
+        session,
+        seqs_to_fetch,
+        partial(fetch_message_records_with_retry, session.server, folder=folder),
+    )
+    return [record for records in batches for record in records]
+
+
+def fetch_folder_chunk(
+    session: ServerSession, folder, seqs_to_fetch
+) -> List[MessageRecord]:
+    """
+    :session: IMAP session owned by the calling thread
+    """
+    if session.selected_folder != folder:
+        logging.debug(f"Processing {folder}")
+        session.server.select_folder(folder)
+        session.selected_folder = folder
+
+    return fetch_message_records(session, seqs_to_fetch, folder)
+
+
+def connect_to_server(hostname: str, username: str, password: str) -> IMAPClient:
+    server = IMAPClient(hostname, 993)
+    server.login(username, password)
+    return server
 
 
 @dataclass
 class CliContext:
     server: IMAPClient
     connection: sqlite3.Connection
+    connect: Callable[[], IMAPClient]
 
 
 @click.group()
@@ -274,37 +356,152 @@ class CliContext:
 def cli(ctx, hostname: str, username: str, password: str, database: str, verbose: bool):
     logging.basicConfig(level=logging.INFO if not verbose else logging.DEBUG)
 
-    server = IMAPClient(hostname, 993)
-    server.login(username, password)
+    server = connect_to_server(hostname, username, password)
     logging.info("Connected to %s as %s", hostname, username)
 
     # import pdb; pdb.set_trace()
 
-    connection = sqlite3.connect(database)
+    connection = sqlite3.connect(database, cached_statements=256)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA temp_store=MEMORY")
+    connection.execute("PRAGMA cache_size=-65536")
+    connection.execute("PRAGMA busy_timeout=30000")
     create_database_tables(connection.cursor())
 
-    ctx.obj = CliContext(server=server, connection=connection)
+    def close_connection():
+        connection.execute("PRAGMA optimize")
+        connection.close()
+
+    ctx.call_on_close(close_connection)
+
+    ctx.obj = CliContext(
+        server=server,
+        connection=connection,
+        connect=partial(connect_to_server, hostname, username, password),
+    )
 
 
 @cli.command(help="Pulls message metadata from IMAP server to determine duplicates")
+@click.option(
+    "--batch-size",
+    default=BATCH_FETCH_LIMIT,
+    type=click.IntRange(min=1),
+    help="Number of messages to fetch per IMAP command",
+)
+@click.option(
+    "--workers",
+    default=PULL_WORKERS,
+    type=click.IntRange(min=1),
+    help="Number of IMAP connections to fetch messages over concurrently",
+)
 @click.pass_context
-def pull(ctx):
+def pull(ctx, batch_size: int, workers: int):
     ctx: CliContext = ctx.obj
+    cursor = ctx.connection.cursor()
 
-    for folder in tqdm([f[2] for f in ctx.server.list_folders()], desc="Folders"):
-        logging.debug(f"Processing {folder}")
-        ctx.server.select_folder(folder)
+    folders = [f[2] for f in ctx.server.list_folders()]
+    existing_seqs = find_seqs_by_folder(cursor)
 
-        for message_seq_chunk in tqdm(
-            chunk(ctx.server.search(), BATCH_FETCH_LIMIT),
-            desc="Messages",
-            colour="green",
-            leave=False,
-            unit_scale=BATCH_FETCH_LIMIT,
-        ):
-            load_messages_fetched_from_imap_with_retry(
-                ctx.connection, ctx.server, message_seq_chunk, folder
-            )
+    # IMAPClient connections are stateful and single-socket, so every worker
+    # thread logs in on its own. Chunks are handed out across all workers, so
+    # a large folder is fetched over several connections at once; each worker
+    # SELECTs a folder the first time it gets one of its chunks. Database
+    # writes stay on this thread, which receives finished futures over a queue.
+    results = queue.Queue()
+    stop = threading.Event()
+    local = threading.local()
+    servers = []
+
+    def fetch_folder_chunk_in_worker(folder, seqs_to_fetch):
+        try:
+            if stop.is_set():
+                return []
+
+            if not hasattr(local, "session"):
+                local.session = ServerSession(ctx.connect(), batch_size)
+                servers.append(local.session.server)
+
+            return fetch_folder_chunk(local.session, folder, seqs_to_fetch)
+        except BaseException:
+            # Stop the remaining chunks without waiting for the writer to
+            # notice the failure
+            stop.set()
+            raise
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(
+            total=len(folders), desc="Folders"
+        ) as folders_progress, tqdm(
+            total=0, desc="Messages", colour="green", leave=False
+        ) as messages_progress:
+            try:
+                # Maps each submitted future to its folder and number of seqs
+                pending = {}
+                chunks_remaining = defaultdict(int)
+                for folder in folders:
+                    if stop.is_set():
+                        break
+
+                    ctx.server.select_folder(folder)
+                    seqs = ctx.server.search()
+                    messages_progress.total += len(seqs)
+                    messages_progress.refresh()
+
+                    for message_seq_chunk in chunk(seqs, batch_size):
+                        seqs_to_fetch = [
+                            s
+                            for s in message_seq_chunk
+                            if s not in existing_seqs[folder]
+                        ]
+                        if len(seqs_to_fetch) == 0:
+                            messages_progress.update(len(message_seq_chunk))
+                            continue
+
+                        future = executor.submit(
+                            fetch_folder_chunk_in_worker, folder, seqs_to_fetch
+                        )
+                        pending[future] = (folder, len(message_seq_chunk))
+                        chunks_remaining[folder] += 1
+                        future.add_done_callback(results.put)
+
+                    if chunks_remaining[folder] == 0:
+                        folders_progress.update()
+
+                messages_since_commit = 0
+                while len(pending) > 0:
+                    future = results.get()
+                    folder, num_seqs = pending.pop(future)
+                    # Re-raises anything that went wrong in the worker
+                    records = future.result()
+
+                    if len(records) > 0:
+                        insert_message_records(cursor, records)
+                    messages_progress.update(num_seqs)
+
+                    # Anything uncommitted is simply pulled again on the next run
+                    messages_since_commit += len(records)
+                    chunks_remaining[folder] -= 1
+                    if (
+                        chunks_remaining[folder] == 0
+                        or messages_since_commit >= BATCH_COMMIT_SIZE
+                    ):
+                        ctx.connection.commit()
+                        messages_since_commit = 0
+
+                    if chunks_remaining[folder] == 0:
+                        folders_progress.update()
+            finally:
+                stop.set()
+    finally:
+        # The executor has shut down, so no worker is still using its session
+        for server in servers:
+            # A failed logout must not mask the error that ended the pull, nor
+            # keep the remaining sessions open
+            try:
+                server.logout()
+            except (IMAPClientError, OSError) as e:
+                logging.warning("Failed to log out of IMAP session: %s", e)
 
 
 @cli.command(help="Finds duplicate messages and inserts them in the database")
@@ -316,9 +513,15 @@ def find_duplicates(ctx, all_mail: str):
     logging.info("Will remove from folders %s", all_mail)
 
     cursor = ctx.connection.cursor()
+    duplicates_cursor = ctx.connection.cursor()
     num_deletions = 0
     space_saved = 0
-    for index, id_ in enumerate(tqdm(find_duplicate_messages(cursor))):
+    for index, id_ in enumerate(
+        tqdm(
+            find_duplicate_messages(duplicates_cursor),
+            total=count_duplicate_messages(cursor),
+        )
+    ):
         for duplicate in [
             d for d in find_message_records_with_id(cursor, id_) if d.folder == all_mail
         ]:
@@ -357,42 +560,49 @@ def print_duplicates(ctx):
 
     cursor = ctx.connection.cursor()
     data = []
-    for id_ in tqdm(find_duplicate_messages(cursor)):
-        messages = find_message_records_with_id(cursor, id_)
-
-        actions = []
-        for message in messages:
-            action = find_action_by_message(cursor, message)
-            actions.append(
-                f'{message.folder} : {action[0].action if len(action) > 0 else "KEEP"}'
-            )
+    for _, rows in tqdm(
+        groupby(find_duplicate_message_actions(cursor), key=itemgetter(0))
+    ):
+        rows = list(rows)
+        actions = [f'{folder} : {action or "KEEP"}' for _, _, folder, action in rows]
 
-        data.append([messages[0].subject, "\n".join(actions)])
+        data.append([rows[0][1], "\n".join(actions)])
 
     print(tabulate(data, headers=["Subject", "Folders"]))
 
 
 @cli.command(help="Performs deduplication")
+@click.option(
+    "--batch-size",
+    default=BATCH_FETCH_LIMIT,
+    type=click.IntRange(min=1),
+    help="Number of messages to delete per IMAP command",
+)
 @click.pass_context
-def deduplicate(ctx):
+def deduplicate(ctx, batch_size: int):
     ctx: CliContext = ctx.obj
     cursor = ctx.connection.cursor()
+    pending_cursor = ctx.connection.cursor()
+    session = ServerSession(ctx.server, batch_size)
 
-    folder_to_actions = defaultdict(list)
-    for action in find_pending_action_records(cursor):
-        folder_to_actions[action.folder].append(action)
-
-    for folder, actions in tqdm(folder_to_actions.items(), desc="Folders"):
+    for folder, rows in tqdm(
+        groupby(find_pending_action_records(pending_cursor), key=itemgetter(0)),
+        desc="Folders",
+    ):
         ctx.server.select_folder(folder)
 
-        chunks = chunk(actions, BATCH_FETCH_LIMIT)
         for chunk_ in tqdm(
-            chunks, desc="Messages", colour="red", unit_scale=BATCH_FETCH_LIMIT
+            chunk((seq for _, seq in rows), batch_size),
+            desc="Messages",
+            colour="red",
+            unit_scale=batch_size,
         ):
             assert len(chunk_) > 0, "Expected chunk to have elements in it"
-            ctx.server.delete_messages([r.seq for r in chunk_])
+            send_in_batches(session, chunk_, ctx.server.delete_messages)
 
         ctx.server.expunge()
+        mark_actions_completed(cursor, folder)
+        ctx.connection.commit()
 
 
 if __name__ == "__main__":